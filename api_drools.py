@@ -1,29 +1,296 @@
+import asyncio
+import concurrent.futures
+import functools
+import hashlib
+import os
+import pickle
+import faiss
+import numpy as np
+from cachetools import TTLCache
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Dict, Any
-from fastapi.responses import Response
-import datetime
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import time
 # Import the clean DroolsRAGPipeline class
 from drools_rag_pipeline import DroolsRAGPipeline
 
+# ---------- Batching Configuration ----------
+MAX_BATCH_SIZE = 8
+BATCH_WINDOW_SECONDS = 0.02  # collect requests for up to 20ms before dispatching
+
+# ---------- Metrics ----------
+# Histograms give p50/p95 via histogram_quantile() on the Prometheus side.
+# With multiple uvicorn workers each process has its own registry, so
+# /metrics returns the samples of whichever worker answered; scrape every
+# worker or switch to prometheus multiprocess mode to aggregate.
+GENERATE_LATENCY = Histogram(
+    "drools_generate_seconds", "End-to-end /generate latency in seconds"
+)
+PIPELINE_LATENCY = Histogram(
+    "drools_pipeline_batch_seconds", "Batched pipeline execution time in seconds"
+)
+# Where batch time goes: embedding, FAISS search, or the completion call
+PIPELINE_STAGE_LATENCY = Histogram(
+    "drools_pipeline_stage_seconds", "Batched pipeline stage latency in seconds", ["stage"]
+)
+
+def observe_stage(stage, seconds):
+    """stage_timer callback for generate_drools_batch"""
+    PIPELINE_STAGE_LATENCY.labels(stage=stage).observe(seconds)
+CACHE_HIT_COUNTER = Counter(
+    "drools_cache_hits_total", "Cache hits by tier", ["tier"]
+)
+GENERATE_REQUESTS = Counter(
+    "drools_generate_requests_total", "Total /generate requests"
+)
+# How full the 20ms/8 batching window actually runs; the basis for tuning
+# MAX_BATCH_SIZE and BATCH_WINDOW_SECONDS
+BATCH_SIZE_HIST = Histogram(
+    "drools_batch_size", "Requests per dispatched pipeline batch",
+    buckets=tuple(range(1, MAX_BATCH_SIZE + 1))
+)
+
+# ---------- Response Cache ----------
+CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+
+response_cache = TTLCache(maxsize=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+cache_lock = asyncio.Lock()
+cache_stats = {"hits": 0, "misses": 0, "semantic_hits": 0, "coalesced": 0}
+
+# In-flight generations by cache key; duplicate queries that arrive while
+# the first one is still running await its future instead of re-generating
+inflight: Dict[str, asyncio.Future] = {}
+
+# ---------- Semantic Cache ----------
+# Second tier behind the exact-match cache: near-duplicate queries
+# ("validate age field" vs "check age field validation") hit here.
+SEM_CACHE_THRESHOLD = float(os.getenv("SEM_CACHE_THRESHOLD", "0.90"))
+SEM_CACHE_MAX_ENTRIES = int(os.getenv("SEM_CACHE_MAX_ENTRIES", "10000"))
+
+sem_index = None   # faiss.IndexIDMap over IndexFlatIP, created on first insert
+sem_store = {}     # cache id -> generated .drl code
+sem_order = []     # insertion order of cache ids, for eviction
+sem_next_id = 0
+
+def semantic_lookup(query_vec):
+    """Return cached code for the nearest stored query if similar enough"""
+    if sem_index is None or sem_index.ntotal == 0:
+        return None
+    scores, ids = sem_index.search(query_vec, 1)
+    if scores[0][0] >= SEM_CACHE_THRESHOLD:
+        return sem_store.get(int(ids[0][0]))
+    return None
+
+def semantic_insert(query_vec, clean_code):
+    """Store a freshly generated result under its query vector, evicting the oldest entry when full"""
+    global sem_index, sem_next_id
+    if sem_index is None:
+        sem_index = faiss.IndexIDMap(faiss.IndexFlatIP(query_vec.shape[1]))
+    if len(sem_order) >= SEM_CACHE_MAX_ENTRIES:
+        oldest = sem_order.pop(0)
+        sem_index.remove_ids(np.array([oldest], dtype=np.int64))
+        sem_store.pop(oldest, None)
+    sem_index.add_with_ids(query_vec, np.array([sem_next_id], dtype=np.int64))
+    sem_store[sem_next_id] = clean_code
+    sem_order.append(sem_next_id)
+    sem_next_id += 1
+
+# ---------- Shared Cache Backend (Redis) ----------
+# With multiple uvicorn workers the in-process caches are per worker.
+# Setting REDIS_URL moves the exact cache to Redis and turns the semantic
+# cache into a shared append-only log that every worker replicates into
+# its local FAISS index.
+redis_client = None
+REDIS_RESP_PREFIX = "drl:resp:"
+REDIS_SEM_KEY = "drl:sem"
+REDIS_SEM_SEQ_KEY = "drl:sem:seq"
+REDIS_MAX_FAILURES = int(os.getenv("REDIS_MAX_FAILURES", "10"))
+sem_last_seq = 0  # highest Redis sequence number replicated into the local index
+redis_failures = 0  # consecutive Redis errors; the backend is dropped past the limit
+
+def note_redis_error(operation, error):
+    """Log a Redis failure and fall back to in-process caches if it keeps happening.
+
+    The cache must never take down the generate path, so callers treat any
+    Redis error as a cache miss and carry on.
+    """
+    global redis_client, redis_failures
+    redis_failures += 1
+    print(f"⚠️ Redis {operation} failed ({error}); using in-process caches")
+    if redis_failures >= REDIS_MAX_FAILURES:
+        print(f"⚠️ Disabling Redis cache after {redis_failures} consecutive failures")
+        redis_client = None
+
+def note_redis_ok():
+    """Reset the consecutive-failure count after a successful Redis call"""
+    global redis_failures
+    redis_failures = 0
+
+async def cached_response_get(key):
+    """Exact-cache lookup, from Redis when configured"""
+    if redis_client is not None:
+        try:
+            value = await redis_client.get(REDIS_RESP_PREFIX + key)
+        except Exception as e:
+            note_redis_error("get", e)
+        else:
+            note_redis_ok()
+            return value.decode() if value is not None else None
+    async with cache_lock:
+        return response_cache.get(key)
+
+async def sync_semantic_from_redis():
+    """Pull semantic-cache entries other workers appended into the local index.
+
+    Entries carry a monotonic sequence number from a Redis counter, so
+    replication tracks the last-seen id rather than list positions and
+    keeps working after the shared log has been trimmed at capacity.
+    The local index stays bounded through semantic_insert's own eviction.
+    """
+    global sem_last_seq
+    try:
+        last_raw = await redis_client.lindex(REDIS_SEM_KEY, -1)
+        if last_raw is None:
+            note_redis_ok()
+            return
+        last_seq = pickle.loads(last_raw)[0]
+        if last_seq <= sem_last_seq:
+            note_redis_ok()
+            return
+        new_count = min(last_seq - sem_last_seq, await redis_client.llen(REDIS_SEM_KEY))
+        entries = await redis_client.lrange(REDIS_SEM_KEY, -new_count, -1)
+    except Exception as e:
+        note_redis_error("sync", e)
+        return
+    note_redis_ok()
+    async with cache_lock:
+        for raw in entries:
+            seq, vec, code = pickle.loads(raw)
+            if seq > sem_last_seq:
+                semantic_insert(vec, code)
+    sem_last_seq = last_seq
+
+async def store_generation(key, query_vec, clean_code):
+    """Record a fresh generation in both cache tiers"""
+    if redis_client is not None:
+        try:
+            await redis_client.set(REDIS_RESP_PREFIX + key, clean_code, ex=CACHE_TTL_SECONDS)
+            seq = await redis_client.incr(REDIS_SEM_SEQ_KEY)
+            await redis_client.rpush(REDIS_SEM_KEY, pickle.dumps((seq, query_vec, clean_code)))
+            await redis_client.ltrim(REDIS_SEM_KEY, -SEM_CACHE_MAX_ENTRIES, -1)
+        except Exception as e:
+            # Fall through and keep the result in the in-process caches
+            note_redis_error("store", e)
+        else:
+            note_redis_ok()
+            await sync_semantic_from_redis()
+            return
+    async with cache_lock:
+        response_cache[key] = clean_code
+        semantic_insert(query_vec, clean_code)
+
+def cache_key(query: str, k: int) -> str:
+    """Hash (query, k) so the cache never stores raw query text as a key"""
+    return hashlib.sha256(f"{query.strip().lower()}|{k}".encode()).hexdigest()
+
+DRL_MEDIA_TYPE = "application/octet-stream"
+
+# Filenames only carry minute granularity, so format the timestamp once
+# per minute instead of calling strftime on every response
+_drl_headers_cache = (None, None)  # (minute bucket, headers dict)
+
+def drl_headers() -> dict:
+    """Download headers with a timestamped .drl filename"""
+    global _drl_headers_cache
+    bucket = int(time.time() // 60)
+    if _drl_headers_cache[0] != bucket:
+        timestamp = time.strftime("%m_%d_%H_%M")
+        _drl_headers_cache = (bucket, {
+            "Content-Disposition": f"attachment; filename=generated_rule_{timestamp}.drl"
+        })
+    return _drl_headers_cache[1]
+
+def build_drl_response(clean_code: str) -> Response:
+    """Package generated Drools code as a downloadable .drl file"""
+    return Response(
+        content=clean_code,
+        media_type=DRL_MEDIA_TYPE,
+        headers=drl_headers()
+    )
+
+async def stream_and_cache(key, query_vec, generator, result_future=None):
+    """Forward streamed deltas to the client, then cache the assembled code.
+
+    The sync OpenAI stream is advanced on the executor so the event loop
+    is never blocked waiting for the next token. When a result future is
+    supplied, coalesced waiters are resolved once the stream completes.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(generator)
+    sentinel = object()
+    parts = []
+    try:
+        while True:
+            piece = await loop.run_in_executor(executor, next, iterator, sentinel)
+            if piece is sentinel:
+                break
+            parts.append(piece)
+            yield piece
+
+        clean_code = "".join(parts).strip()
+        await store_generation(key, query_vec, clean_code)
+        if result_future is not None and not result_future.done():
+            result_future.set_result(clean_code)
+    except BaseException as e:
+        if result_future is not None and not result_future.done():
+            error = e if isinstance(e, Exception) else RuntimeError("stream aborted")
+            result_future.set_exception(error)
+            result_future.exception()  # waiters retrieve it; silence the GC warning
+        raise
+    finally:
+        inflight.pop(key, None)
+
 # ---------- Request/Response Models ----------
+MAX_QUERY_CHARS = int(os.getenv("MAX_QUERY_CHARS", "2000"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "64"))
+
+# Frozen, closed models: immutable once validated, unknown fields rejected,
+# and the compiled validators are reused across requests
 class GenerateRequest(BaseModel):
-    query: str = Field(..., min_length=3, description="Query for Drools rule generation")
+    model_config = ConfigDict(frozen=True, extra="forbid", str_strip_whitespace=True)
+
+    query: str = Field(..., min_length=3, max_length=MAX_QUERY_CHARS,
+                       description="Query for Drools rule generation")
     k: int = Field(15, ge=1, le=50, description="Number of chunks to retrieve")
+    stream: bool = Field(False, description="Stream the .drl as it is generated instead of buffering it")
 
 class Chunk(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     content: str
     score: float
 
 class GenerateResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     drools_code: str
 
 # ---------- FastAPI App ----------
 app = FastAPI(
     title="Drools RAG API",
     version="1.0.1",
-    description="API for generating Drools rules using RAG pipeline"
+    description="API for generating Drools rules using RAG pipeline",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware
@@ -35,25 +302,111 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress .drl downloads (and other large responses) when the client
+# sends Accept-Encoding: gzip; tiny payloads are left alone
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # ---------- Global Pipeline Instance ----------
 pipeline: DroolsRAGPipeline = None
+request_queue: asyncio.Queue = None
+executor: concurrent.futures.ThreadPoolExecutor = None
+
+# Static per process; loaded once at startup instead of per request
+form_content: str = None
+java_model_content: str = None
+
+EXECUTOR_MAX_WORKERS = int(os.getenv("EXECUTOR_MAX_WORKERS", "8"))
+
+async def batch_worker():
+    """Collect queued requests into small batches and run them through the pipeline.
+
+    Waits for the first request, then keeps pulling more for up to
+    BATCH_WINDOW_SECONDS (or until MAX_BATCH_SIZE), so concurrent callers
+    share one batched embedding call and parallel completions.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await request_queue.get()]
+        while len(batch) < MAX_BATCH_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(
+                    request_queue.get(), timeout=BATCH_WINDOW_SECONDS
+                ))
+            except asyncio.TimeoutError:
+                break
+
+        BATCH_SIZE_HIST.observe(len(batch))
+        queries = [req.query for req, _ in batch]
+        ks = [req.k for req, _ in batch]
+
+        try:
+            with PIPELINE_LATENCY.time():
+                results = await loop.run_in_executor(
+                    executor,
+                    functools.partial(
+                        pipeline.generate_drools_batch,
+                        queries, form_content, java_model_content, ks,
+                        stage_timer=observe_stage
+                    )
+                )
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize the pipeline on startup"""
-    global pipeline
+    global pipeline, request_queue, executor, form_content, java_model_content
     try:
         print("Initializing Drools RAG Pipeline...")
         pipeline = DroolsRAGPipeline()
 
+        # Executor for blocking pipeline work, so the event loop stays free
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS)
+
         # Load vector database
         pipeline.load_vector_db()
+
+        # Preload static inputs so requests never touch the filesystem
+        form_content = DroolsRAGPipeline.load_form()
+        java_model_content = DroolsRAGPipeline.load_java_model()
+
+        # Shared cache backend for multi-worker deployments
+        redis_url = os.getenv("REDIS_URL")
+        if redis_url and aioredis is not None:
+            global redis_client
+            try:
+                redis_client = aioredis.from_url(redis_url)
+                await redis_client.ping()
+                print("✅ Redis cache connected")
+            except Exception as redis_err:
+                redis_client = None
+                print(f"⚠️ Redis unavailable ({redis_err}); using in-process caches")
+
+        # Start the batching worker; the bounded queue provides backpressure
+        request_queue = asyncio.Queue(maxsize=MAX_QUEUE_DEPTH)
+        asyncio.create_task(batch_worker())
         print("✅ Pipeline initialized and vector database loaded!")
 
     except Exception as e:
         print(f"❌ Error initializing pipeline: {str(e)}")
         raise RuntimeError(f"Failed to initialize pipeline: {str(e)}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the executor on shutdown"""
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics in text exposition format"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -74,29 +427,87 @@ async def generate_drools_file(request: GenerateRequest):
             detail="Pipeline not initialized. Check server logs."
         )
     
+    GENERATE_REQUESTS.inc()
+    start_time = time.perf_counter()
     try:
-        # Load form and Java model content
-        form_content = DroolsRAGPipeline.load_form()
-        java_model_content = DroolsRAGPipeline.load_java_model()
-        
-        # Call generate_drools with all required parameters
-        drools_code, chunks = pipeline.generate_drools(
-            query=request.query,
-            form_content=form_content,
-            java_model_content=java_model_content,
-            k=request.k
-        )
-        clean_code = drools_code.strip()
-        timestamp = datetime.datetime.now().strftime("%m_%d_%H_%M")
-        filename = f"generated_rule_{timestamp}.drl"
-        
-        # Return as downloadable file
-        return Response(
-            content=clean_code,
-            media_type="application/octet-stream",
-            headers={"Content-Disposition": f"attachment; filename={filename}"}
-        )
+        key = cache_key(request.query, request.k)
+
+        # Serve repeated queries straight from the cache
+        cached_code = await cached_response_get(key)
+        if cached_code is not None:
+            cache_stats["hits"] += 1
+            CACHE_HIT_COUNTER.labels(tier="exact").inc()
+            return build_drl_response(cached_code)
+
+        # Coalesce with an identical query that is already being generated
+        existing = inflight.get(key)
+        if existing is not None:
+            cache_stats["coalesced"] += 1
+            return build_drl_response(await existing)
+
+        loop = asyncio.get_running_loop()
+        result_future = loop.create_future()
+        inflight[key] = result_future
+        try:
+            # Exact miss: try the semantic cache with the query embedding
+            query_vec = await loop.run_in_executor(executor, pipeline.embed_query, request.query)
+            query_vec = query_vec.reshape(1, -1)
+            faiss.normalize_L2(query_vec)
+
+            if redis_client is not None:
+                await sync_semantic_from_redis()
+            async with cache_lock:
+                cached_code = semantic_lookup(query_vec)
+            if cached_code is not None:
+                cache_stats["semantic_hits"] += 1
+                CACHE_HIT_COUNTER.labels(tier="semantic").inc()
+                result_future.set_result(cached_code)
+                return build_drl_response(cached_code)
+            cache_stats["misses"] += 1
+
+            # Stream fresh generations straight to the client when asked;
+            # stream_and_cache resolves the in-flight future at stream end
+            if request.stream:
+                generator = pipeline.generate_drools_stream(
+                    request.query, form_content, java_model_content, request.k
+                )
+                return StreamingResponse(
+                    stream_and_cache(key, query_vec, generator, result_future),
+                    media_type=DRL_MEDIA_TYPE,
+                    headers=drl_headers()
+                )
+
+            # Queue the request and wait for the batch worker to resolve it;
+            # shed load instead of piling up work when the queue is full
+            future = loop.create_future()
+            try:
+                request_queue.put_nowait((request, future))
+            except asyncio.QueueFull:
+                raise HTTPException(
+                    status_code=429,
+                    detail="Server is at capacity. Retry shortly.",
+                    headers={"Retry-After": "1"}
+                )
+            drools_code, chunks = await future
+            clean_code = drools_code.strip()
+
+            await store_generation(key, query_vec, clean_code)
+            result_future.set_result(clean_code)
+
+            # Return as downloadable file
+            return build_drl_response(clean_code)
+        except BaseException as e:
+            if not result_future.done():
+                result_future.set_exception(e)
+                result_future.exception()  # waiters retrieve it; silence the GC warning
+            raise
+        finally:
+            # The streaming path stays in-flight until stream_and_cache finishes
+            if not request.stream or result_future.done():
+                inflight.pop(key, None)
         
+    except HTTPException:
+        raise
     except FileNotFoundError as e:
         raise HTTPException(
             status_code=400,
@@ -107,29 +518,68 @@ async def generate_drools_file(request: GenerateRequest):
             status_code=500,
             detail=f"Error generating Drools code: {str(e)}"
         )
+    finally:
+        GENERATE_LATENCY.observe(time.perf_counter() - start_time)
+
+# /info answers are identical between consecutive calls apart from slowly
+# moving counters, so rebuild the payload at most once per refresh window
+INFO_REFRESH_SECONDS = float(os.getenv("INFO_REFRESH_SECONDS", "30"))
+_info_cache = None
+_info_cache_time = 0.0
+
+def build_info() -> dict:
+    """Assemble the /info payload from loaded resources and cache stats"""
+    try:
+        # Bytes stored per vector; shows whether SQ8 quantization is active
+        code_size = pipeline.index.sa_code_size() if pipeline.index is not None else 0
+    except RuntimeError:
+        code_size = None
+    return {
+        "form_loaded": "Form content not found" not in form_content,
+        "form_size": len(form_content),
+        "java_model_loaded": "Java model file not found" not in java_model_content,
+        "java_model_size": len(java_model_content),
+        "faiss_index_loaded": pipeline.index is not None,
+        "index_type": type(pipeline.index).__name__ if pipeline.index is not None else None,
+        "index_ntotal": pipeline.index.ntotal if pipeline.index is not None else 0,
+        "index_code_size_bytes": code_size,
+        "metadata_loaded": pipeline.metadata is not None,
+        "metadata_entries": len(pipeline.metadata) if pipeline.metadata else 0,
+        "cache_hits": cache_stats["hits"],
+        "cache_misses": cache_stats["misses"],
+        "cache_entries": len(response_cache),
+        "semantic_cache_hits": cache_stats["semantic_hits"],
+        "semantic_cache_entries": len(sem_store),
+        "coalesced_requests": cache_stats["coalesced"],
+        "cache_backend": "redis" if redis_client is not None else "memory"
+    }
 
 @app.get("/info")
 async def get_info():
-    """Get information about loaded resources"""
+    """Get information about loaded resources (refreshed every INFO_REFRESH_SECONDS)"""
+    global _info_cache, _info_cache_time
     if pipeline is None:
         raise HTTPException(status_code=503, detail="Pipeline not initialized")
 
     try:
-        form_content = DroolsRAGPipeline.load_form()
-        java_model_content = DroolsRAGPipeline.load_java_model()
-
-        return {
-            "form_loaded": "Form content not found" not in form_content,
-            "form_size": len(form_content),
-            "java_model_loaded": "Java model file not found" not in java_model_content,
-            "java_model_size": len(java_model_content),
-            "faiss_index_loaded": pipeline.index is not None,
-            "metadata_loaded": pipeline.metadata is not None,
-            "metadata_entries": len(pipeline.metadata) if pipeline.metadata else 0
-        }
+        now = time.monotonic()
+        if _info_cache is None or now - _info_cache_time >= INFO_REFRESH_SECONDS:
+            _info_cache = build_info()
+            _info_cache_time = now
+        return _info_cache
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8503)
+    # Multiple workers need the app as an import string; uvloop replaces
+    # the default event loop and httptools the h11 HTTP parser for lower
+    # per-request overhead
+    uvicorn.run(
+        "api_drools:app",
+        host="0.0.0.0",
+        port=8503,
+        workers=int(os.getenv("UVICORN_WORKERS", "4")),
+        loop="uvloop",
+        http="httptools"
+    )
@@ -1,7 +1,9 @@
 import os
 import pickle
+import time
 import numpy as np
 import faiss
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
 from dotenv import load_dotenv
 
@@ -16,38 +18,133 @@ class DroolsRAGPipeline:
         self.client = OpenAI(api_key=self.api_key)
         self.index = None
         self.metadata = None
+        # "openai" (default) or "local"; local runs a CPU model instead of the embeddings API
+        self.embedding_backend = os.getenv("EMBEDDING_BACKEND", "openai").lower()
+        self._local_embedder = None
+
+    @staticmethod
+    def _prefetch(path, chunk_size=1 << 20):
+        """Read a file front to back so its pages are in the OS cache before parsing"""
+        with open(path, 'rb') as f:
+            while f.read(chunk_size):
+                pass
+
+    def load_vector_db(self, faiss_path="data/model/faiss_index.bin", metadata_path="data/model/metadata.pkl", index_type=None):
+        """Load FAISS index and metadata, optionally converting to HNSW for sub-linear search"""
+        def read_faiss():
+            # Warm the page cache so read_index doesn't stall on cold disk reads
+            self._prefetch(faiss_path)
+            if os.getenv("FAISS_MMAP", "0").lower() in ("1", "true"):
+                # Memory-map the index instead of copying it into the heap
+                return faiss.read_index(faiss_path, faiss.IO_FLAG_MMAP)
+            return faiss.read_index(faiss_path)
+
+        def read_metadata():
+            self._prefetch(metadata_path)
+            with open(metadata_path, 'rb') as f:
+                return pickle.load(f)
+
+        # The two files are independent, so prefetch and parse them in parallel
+        with ThreadPoolExecutor(max_workers=2) as loader:
+            index_future = loader.submit(read_faiss)
+            metadata_future = loader.submit(read_metadata)
+            self.index = index_future.result()
+            self.metadata = metadata_future.result()
+
+        index_type = (index_type or os.getenv("FAISS_INDEX_TYPE", "hnsw")).lower()
+        quantize = os.getenv("FAISS_QUANTIZE", "0").lower() in ("1", "true", "sq8")
+        if isinstance(self.index, faiss.IndexFlat):
+            if index_type == "hnsw":
+                self.index = self._to_hnsw(self.index, quantize=quantize)
+            elif quantize:
+                self.index = self._to_sq8(self.index)
 
-    def load_vector_db(self, faiss_path="data/model/faiss_index.bin", metadata_path="data/model/metadata.pkl"):
-        """Load FAISS index and metadata"""
-        self.index = faiss.read_index(faiss_path)
-        with open(metadata_path, 'rb') as f:
-            self.metadata = pickle.load(f)
         return self.index, self.metadata
 
+    @staticmethod
+    def _to_hnsw(flat_index, m=32, ef_construction=200, ef_search=64, quantize=False):
+        """Rebuild a flat index as HNSW so search is sub-linear instead of brute force.
+
+        With quantize=True the stored vectors are 8-bit scalar quantized,
+        cutting index memory (and bandwidth per distance computation) to a
+        quarter of float32 at a small recall cost.
+        """
+        vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+        if quantize:
+            hnsw = faiss.IndexHNSWSQ(flat_index.d, faiss.ScalarQuantizer.QT_8bit, m, faiss.METRIC_INNER_PRODUCT)
+            hnsw.train(vectors)
+        else:
+            hnsw = faiss.IndexHNSWFlat(flat_index.d, m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        hnsw.hnsw.efSearch = ef_search
+        hnsw.add(vectors)
+        return hnsw
+
+    @staticmethod
+    def _to_sq8(flat_index):
+        """Rebuild a flat index with 8-bit scalar quantized storage"""
+        vectors = flat_index.reconstruct_n(0, flat_index.ntotal)
+        sq = faiss.IndexScalarQuantizer(flat_index.d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        sq.train(vectors)
+        sq.add(vectors)
+        return sq
+
+    def _get_local_embedder(self):
+        """Lazily load the local embedding model (optional dependency)"""
+        if self._local_embedder is None:
+            from sentence_transformers import SentenceTransformer
+            model_name = os.getenv("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+            # The ONNX backend runs quantized CPU inference without a GPU
+            backend = os.getenv("LOCAL_EMBEDDING_BACKEND", "onnx")
+            self._local_embedder = SentenceTransformer(model_name, backend=backend)
+        return self._local_embedder
+
     def embed_query(self, query):
         """Generate embedding for query"""
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries):
+        """Generate embeddings for multiple queries in one batched call"""
+        if self.embedding_backend == "local":
+            vectors = self._get_local_embedder().encode(
+                queries, batch_size=len(queries), convert_to_numpy=True
+            ).astype(np.float32)
+            if self.index is not None and vectors.shape[1] != self.index.d:
+                raise ValueError(
+                    f"Local embedder dimension {vectors.shape[1]} does not match index "
+                    f"dimension {self.index.d}; rebuild the index with the local model "
+                    "or unset EMBEDDING_BACKEND."
+                )
+            return vectors
         response = self.client.embeddings.create(
             model="text-embedding-3-large",
-            input=query
+            input=queries
         )
-        return np.array(response.data[0].embedding, dtype=np.float32)
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+    @staticmethod
+    def expand_query(query):
+        """Add domain keywords to improve retrieval"""
+        return f"{query} tax calculation Maryland county rate filing status income threshold deduction"
 
     def search_chunks(self, query, k=15):
         """Search for relevant chunks with query expansion and diversity filtering"""
-        e_query = f"{query} tax calculation Maryland county rate filing status income threshold deduction"
-        query_embedding = self.embed_query(e_query).reshape(1, -1)
-        
+        query_embedding = self.embed_query(self.expand_query(query)).reshape(1, -1)
+        return self._search_with_embedding(query_embedding, k)
+
+    def _search_with_embedding(self, query_embedding, k=15):
+        """Search the index with a precomputed query embedding and apply diversity filtering"""
         # Get more results than needed for diversity filtering
         scores, indices = self.index.search(query_embedding, k*2)
-        
+
         chunks = []
         seen_embeddings = []
-        
+
         for score, idx in zip(scores[0], indices[0]):
             if idx >= 0 and idx < len(self.metadata):
                 # Get current chunk embedding for similarity check
                 current_emb = self.index.reconstruct(int(idx))
-                
+
                 # Check if too similar to already selected chunks
                 too_similar = False
                 for prev_emb in seen_embeddings:
@@ -55,14 +152,14 @@ class DroolsRAGPipeline:
                     if similarity > 0.95:  # 95% similarity threshold
                         too_similar = True
                         break
-                
+
                 if not too_similar:
                     chunks.append({
                         'content': self.metadata[idx].get('text', ''),
                         'score': float(score)
                     })
                     seen_embeddings.append(current_emb)
-                    
+
                     if len(chunks) >= k:
                         break
         return chunks
@@ -211,6 +308,16 @@ You MUST reproduce that **exact logic**, including numeric thresholds, inside th
 
         return prompt
 
+    def _complete(self, prompt):
+        """Run a single chat completion for a prepared prompt"""
+        response = self.client.chat.completions.create(
+            model="gpt-4.1",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.0,
+            max_tokens=6000
+        )
+        return response.choices[0].message.content
+
     def generate_drools(self, query, form_content, java_model_content, k=15):
         """Main pipeline function"""
         # Search for relevant chunks
@@ -220,14 +327,64 @@ You MUST reproduce that **exact logic**, including numeric thresholds, inside th
         prompt = self.create_prompt(form_content, chunks, query, java_model_content)
 
         # Generate Drools code
-        response = self.client.chat.completions.create(
+        return self._complete(prompt), chunks
+
+    def generate_drools_stream(self, query, form_content, java_model_content, k=15):
+        """Stream generated Drools code as it is produced by the model.
+
+        Yields content deltas so callers can forward output to the client
+        instead of waiting for the whole completion to finish.
+        """
+        chunks = self.search_chunks(query, k)
+        prompt = self.create_prompt(form_content, chunks, query, java_model_content)
+
+        stream = self.client.chat.completions.create(
             model="gpt-4.1",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.0,
-            max_tokens=6000
+            max_tokens=6000,
+            stream=True
         )
+        for event in stream:
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+
+    def generate_drools_batch(self, queries, form_content, java_model_content, ks, stage_timer=None):
+        """Run the pipeline for multiple queries at once.
+
+        Embeds all queries in one API call, searches the index per query,
+        then issues the chat completions in parallel. Returns a list of
+        (drools_code, chunks) tuples in the same order as the queries.
+        An optional stage_timer(stage, seconds) callback receives the time
+        spent in the embed, search, and llm stages.
+        """
+        def timed(stage, func):
+            if stage_timer is None:
+                return func()
+            start = time.perf_counter()
+            try:
+                return func()
+            finally:
+                stage_timer(stage, time.perf_counter() - start)
+
+        expanded = [self.expand_query(q) for q in queries]
+        embeddings = timed("embed", lambda: self.embed_queries(expanded))
+
+        chunk_lists = timed("search", lambda: [
+            self._search_with_embedding(embeddings[i].reshape(1, -1), ks[i])
+            for i in range(len(queries))
+        ])
+        prompts = [
+            self.create_prompt(form_content, chunks, query, java_model_content)
+            for query, chunks in zip(queries, chunk_lists)
+        ]
+
+        def run_completions():
+            with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+                return list(executor.map(self._complete, prompts))
 
-        return response.choices[0].message.content, chunks
+        codes = timed("llm", run_completions)
+        return list(zip(codes, chunk_lists))
 
 
 # Example usage for testing
@@ -54,12 +54,17 @@ def install_requirements(project_dir, venv_python):
     if not requirement_file.exists():
         print("Creating requirements.txt...")
         basic_requirements = """fastapi>=0.104.0
+orjson
 uvicorn[standard]
+uvloop; sys_platform != 'win32'
 openai
 faiss-cpu
+cachetools
+redis
+prometheus-client
 python-dotenv
 numpy
-pydantic
+pydantic>=2.5
 python-multipart"""
         requirement_file.write_text(basic_requirements)
 
@@ -92,7 +97,7 @@ def create_run_script(project_dir):
         script_content = """@echo off
 call venv\Scripts\activate.bat
 echo Starting Drools API...
-python -m uvicorn api_drools:app --host 0.0.0.0 --port 8503 --reload
+python -m uvicorn api_drools:app --host 0.0.0.0 --port 8503 --workers 4 --http httptools
 """
         script_path = project_dir / "run_api.bat"
     else:
@@ -100,7 +105,7 @@ python -m uvicorn api_drools:app --host 0.0.0.0 --port 8503 --reload
         script_content = """#!/bin/bash
 source venv/bin/activate
 echo "Starting Drools API..."
-python -m uvicorn api_drools:app --host 0.0.0.0 --port 8503 --reload
+python -m uvicorn api_drools:app --host 0.0.0.0 --port 8503 --workers "${UVICORN_WORKERS:-4}" --loop uvloop --http httptools
 """
         script_path = project_dir / "run_api.sh"
 